@@ -1,23 +1,200 @@
 # -*- coding: utf-8 -*-
 """A collection of combination methods for combining raw scores.
+
+Score matrices of dtype float32 are combined in float32, which halves the
+memory traffic at the cost of precision; all other inputs are converted to
+float64.
 """
 # Author: Yue Zhao <zhaoy@cmu.edu>
 # License: BSD 2 clause
 
 
+import numbers
+from functools import lru_cache
+
 import numpy as np
-from numpy.random import RandomState
 from sklearn.utils import check_array
+from sklearn.utils import check_random_state
 from sklearn.utils import column_or_1d
 # noinspection PyProtectedMember
 from sklearn.utils import shuffle
-from sklearn.utils.extmath import weighted_mode
 from sklearn.utils.random import sample_without_replacement
 from numpy.testing import assert_equal
 from sklearn.utils.multiclass import check_classification_targets
 
 from pyod.utils.utility import check_parameter
 
+try:
+    import numba
+except ImportError:  # pragma: no cover
+    numba = None
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _weighted_mode_rows(scores, weights, n_classes, out):
+        """Internal kernel of majority vote. Write the label with the largest
+        total weight of each row of scores into out.
+        """
+        n_samples, n_estimators = scores.shape
+        for i in numba.prange(n_samples):
+            # the tally is local to the row so threads never share it
+            tally = np.zeros(n_classes)
+            for j in range(n_estimators):
+                tally[scores[i, j]] += weights[j]
+
+            # like weighted_mode, only a positive total weight wins a vote
+            best = 0
+            best_weight = 0.0
+            for c in range(n_classes):
+                if tally[c] > best_weight:
+                    best = c
+                    best_weight = tally[c]
+            out[i] = best
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _row_max(scores, out):
+        """Internal kernel of maximization. Write the maximum of each row of
+        scores into out.
+        """
+        for i in numba.prange(scores.shape[0]):
+            row_max = scores[i, 0]
+            for j in range(1, scores.shape[1]):
+                value = scores[i, j]
+                row_max = value if value > row_max else row_max
+            out[i] = row_max
+
+    # the AOM/MOA kernels sum in order, while the NumPy fallback relies on
+    # pairwise summation and BLAS, so both agree up to rounding only
+    @numba.njit(parallel=True, cache=True)
+    def _aom_kernel(buckets, out):
+        """Internal kernel of static AOM. Write the average of the bucket
+        maximums of each sample into out.
+        """
+        n_samples, n_buckets, n_estimators_per_bucket = buckets.shape
+        for i in numba.prange(n_samples):
+            total = 0.0
+            for b in range(n_buckets):
+                bucket_max = buckets[i, b, 0]
+                for j in range(1, n_estimators_per_bucket):
+                    if buckets[i, b, j] > bucket_max:
+                        bucket_max = buckets[i, b, j]
+                total += bucket_max
+            out[i] = total / n_buckets
+
+    @numba.njit(parallel=True, cache=True)
+    def _moa_kernel(buckets, out):
+        """Internal kernel of static MOA. Write the maximum of the bucket
+        averages of each sample into out.
+        """
+        n_samples, n_buckets, n_estimators_per_bucket = buckets.shape
+        for i in numba.prange(n_samples):
+            best = -np.inf
+            for b in range(n_buckets):
+                total = 0.0
+                for j in range(n_estimators_per_bucket):
+                    total += buckets[i, b, j]
+                bucket_mean = total / n_estimators_per_bucket
+                if bucket_mean > best:
+                    best = bucket_mean
+            out[i] = best
+else:  # pragma: no cover
+    _weighted_mode_rows = None
+    _row_max = None
+    _aom_kernel = None
+    _moa_kernel = None
+
+
+def _make_buckets(n_estimators, n_buckets, method, bootstrap_estimators,
+                  random_state):
+    """Internal helper function to draw the estimator indices of each
+    subgroup for Average of Maximum (AOM) and Maximum of Average (MOA).
+
+    Parameters
+    ----------
+    n_estimators : int
+        The number of estimators to divide into subgroups.
+
+    n_buckets : int
+        The number of subgroups to build.
+
+    method : str
+        {'static', 'dynamic'}, if 'dynamic', build subgroups
+        randomly with dynamic bucket size.
+
+    bootstrap_estimators : bool
+        Whether estimators are drawn with replacement.
+
+    random_state : int, RandomState instance or None
+        If int, random_state is the seed used by the
+        random number generator; If RandomState instance, random_state is
+        the random number generator; If None, the random number generator
+        is the RandomState instance used by `np.random`.
+
+    Returns
+    -------
+    bucket_ind : numpy array
+        The estimator indices of the subgroups. Of shape
+        (n_buckets, n_estimators_per_bucket) in static mode, and the
+        concatenated indices of all subgroups in dynamic mode.
+
+    bucket_sizes : numpy array of shape (n_buckets,)
+        The number of estimators in each subgroup.
+
+    """
+    # draw all subgroups from a single generator, so that an integer seed
+    # does not give every subgroup the same draw
+    random_state = check_random_state(random_state)
+
+    if method == 'static':
+        n_estimators_per_bucket = int(n_estimators / n_buckets)
+        bucket_sizes = np.full(n_buckets, n_estimators_per_bucket,
+                               dtype=np.intp)
+
+        if not bootstrap_estimators:
+            # shuffle the estimator order
+            bucket_ind = shuffle(np.arange(n_estimators, dtype=np.intp),
+                                 random_state=random_state)
+        else:
+            bucket_ind = np.asarray(
+                [sample_without_replacement(n_estimators,
+                                            n_estimators_per_bucket,
+                                            random_state=random_state)
+                 for _ in range(n_buckets)], dtype=np.intp)
+        bucket_ind = bucket_ind.reshape(n_buckets, n_estimators_per_bucket)
+
+    else:
+        # the number of estimators in a bucket should be 2 - n/2
+        bucket_sizes = random_state.randint(2, int(n_estimators / 2),
+                                            size=n_buckets)
+        bucket_ind = np.concatenate(
+            [sample_without_replacement(n_estimators, bucket_size,
+                                        random_state=random_state)
+             for bucket_size in bucket_sizes])
+
+    # the plans may be shared through the cache, guard them from edits
+    bucket_ind.setflags(write=False)
+    bucket_sizes.setflags(write=False)
+    return bucket_ind, bucket_sizes
+
+
+_make_buckets_cached = lru_cache(maxsize=32)(_make_buckets)
+
+
+def _get_buckets(n_estimators, n_buckets, method, bootstrap_estimators,
+                 random_state):
+    """Internal helper function to look up the subgroup plan of
+    :func:`_make_buckets`. Plans drawn with an integer seed are deterministic
+    and hence cached, so repeated calls with the same configuration skip the
+    sampling step.
+    """
+    if isinstance(random_state, numbers.Integral):
+        return _make_buckets_cached(n_estimators, n_buckets, method,
+                                    bool(bootstrap_estimators),
+                                    int(random_state))
+    return _make_buckets(n_estimators, n_buckets, method,
+                         bootstrap_estimators, random_state)
+
 
 def _aom_moa_helper(mode, scores, n_buckets, method, bootstrap_estimators,
                     random_state):
@@ -63,7 +240,7 @@ def _aom_moa_helper(mode, scores, n_buckets, method, bootstrap_estimators,
         raise NotImplementedError(
             '{mode} is not implemented'.format(mode=mode))
 
-    scores = check_array(scores)
+    scores = check_array(scores, dtype=[np.float64, np.float32])
     # TODO: add one more parameter for max number of estimators
     # use random_state instead
     # for now it is fixed at n_estimators/2
@@ -71,60 +248,60 @@ def _aom_moa_helper(mode, scores, n_buckets, method, bootstrap_estimators,
     check_parameter(n_buckets, 2, n_estimators, include_left=True,
                     include_right=True, param_name='n_buckets')
 
-    scores_buckets = np.zeros([scores.shape[0], n_buckets])
-
     if method == 'static':
-
-        n_estimators_per_bucket = int(n_estimators / n_buckets)
         if n_estimators % n_buckets != 0:
             raise ValueError('n_estimators / n_buckets has a remainder. Not '
                              'allowed in static mode.')
+    elif method != 'dynamic':
+        raise NotImplementedError(
+            '{method} is not implemented'.format(method=method))
 
-        if not bootstrap_estimators:
-            # shuffle the estimator order
-            shuffled_list = shuffle(list(range(0, n_estimators, 1)),
-                                    random_state=random_state)
-
-            head = 0
-            for i in range(0, n_estimators, n_estimators_per_bucket):
-                tail = i + n_estimators_per_bucket
-                batch_ind = int(i / n_estimators_per_bucket)
-                if mode == 'AOM':
-                    scores_buckets[:, batch_ind] = np.max(
-                        scores[:, shuffled_list[head:tail]], axis=1)
-                else:
-                    scores_buckets[:, batch_ind] = np.mean(
-                        scores[:, shuffled_list[head:tail]], axis=1)
-
-                # increment index
-                head = head + n_estimators_per_bucket
-                # noinspection PyUnusedLocal
-        else:
-            for i in range(n_buckets):
-                ind = sample_without_replacement(n_estimators,
-                                                 n_estimators_per_bucket,
-                                                 random_state=random_state)
-                if mode == 'AOM':
-                    scores_buckets[:, i] = np.max(scores[:, ind], axis=1)
-                else:
-                    scores_buckets[:, i] = np.mean(scores[:, ind], axis=1)
-
-    elif method == 'dynamic':  # random bucket size
-        for i in range(n_buckets):
-            # the number of estimators in a bucket should be 2 - n/2
-            max_estimator_per_bucket = RandomState(seed=random_state).randint(
-                2, int(n_estimators / 2))
-            ind = sample_without_replacement(n_estimators,
-                                             max_estimator_per_bucket,
-                                             random_state=random_state)
+    bucket_ind, bucket_sizes = _get_buckets(n_estimators, n_buckets, method,
+                                            bootstrap_estimators,
+                                            random_state)
+
+    if method == 'static':
+        # arrange the estimators of each bucket along the last axis so all
+        # buckets are reduced in a single call
+        buckets = np.take(scores, bucket_ind.ravel(), axis=1).reshape(
+            scores.shape[0], n_buckets, bucket_sizes[0])
+
+        # fuse both reductions into one pass over the buckets per sample
+        if _aom_kernel is not None:
+            combined_scores = np.empty(scores.shape[0], dtype=scores.dtype)
             if mode == 'AOM':
-                scores_buckets[:, i] = np.max(scores[:, ind], axis=1)
+                _aom_kernel(buckets, combined_scores)
             else:
-                scores_buckets[:, i] = np.mean(scores[:, ind], axis=1)
+                _moa_kernel(buckets, combined_scores)
+            return combined_scores
 
+        # chain both reductions so the small (n_samples, n_buckets)
+        # intermediate stays in cache
+        if mode == 'AOM':
+            return buckets.max(axis=2).mean(axis=1)
+        else:
+            # the bucket average is a linear contraction of the last axis,
+            # computed as a single matrix-vector product
+            n_estimators_per_bucket = bucket_sizes[0]
+            mean_weights = np.full(n_estimators_per_bucket,
+                                   1. / n_estimators_per_bucket,
+                                   dtype=scores.dtype)
+            bucket_means = np.dot(
+                buckets.reshape(-1, n_estimators_per_bucket), mean_weights)
+            return bucket_means.reshape(-1, n_buckets).max(axis=1)
+
+    # random bucket size: gather all buckets into one contiguous block and
+    # reduce each bucket segment in place
+    bucket_offsets = np.cumsum(np.r_[0, bucket_sizes[:-1]])
+    buckets = scores[:, bucket_ind]
+    scores_buckets = np.empty((scores.shape[0], n_buckets),
+                              dtype=scores.dtype)
+    if mode == 'AOM':
+        np.maximum.reduceat(buckets, bucket_offsets, axis=1,
+                            out=scores_buckets)
     else:
-        raise NotImplementedError(
-            '{method} is not implemented'.format(method=method))
+        np.add.reduceat(buckets, bucket_offsets, axis=1, out=scores_buckets)
+        scores_buckets /= bucket_sizes
 
     if mode == 'AOM':
         return np.mean(scores_buckets, axis=1)
@@ -211,7 +388,27 @@ def moa(scores, n_buckets=5, method='static', bootstrap_estimators=False,
                            bootstrap_estimators, random_state)
 
 
-def average(scores, estimator_weights=None):
+def _normalize_weights(weights):
+    """Internal helper function to scale the estimator weights so that they
+    sum up to one. The output can be passed to :func:`average` with
+    ``_pre_normalized=True`` to skip the normalization on every call.
+
+    Parameters
+    ----------
+    weights : numpy array of shape (1, n_estimators)
+        The estimator weights.
+
+    Returns
+    -------
+    normalized_weights : numpy array of shape (1, n_estimators)
+        The estimator weights divided by their sum.
+
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    return weights / np.sum(weights)
+
+
+def average(scores, estimator_weights=None, *, _pre_normalized=False):
     """Combination method to merge the scores from multiple estimators
     by taking the average.
 
@@ -223,13 +420,17 @@ def average(scores, estimator_weights=None):
     estimator_weights : numpy array of shape (1, n_estimators)
         If specified, using weighted average.
 
+    _pre_normalized : bool, optional (default=False)
+        If True, estimator_weights are assumed to sum up to one already,
+        e.g., from :func:`_normalize_weights`, and are used as they are.
+
     Returns
     -------
     combined_scores : numpy array of shape (n_samples, )
         The combined scores.
 
     """
-    scores = check_array(scores)
+    scores = check_array(scores, dtype=[np.float64, np.float32])
 
     if estimator_weights is not None:
         if estimator_weights.shape != (1, scores.shape[1]):
@@ -240,13 +441,20 @@ def average(scores, estimator_weights=None):
                     estimator_weights=estimator_weights.shape))
 
         # (d1*w1 + d2*w2 + ...+ dn*wn)/(w1+w2+...+wn)
-        # generated weighted scores
-        scores = np.sum(np.multiply(scores, estimator_weights),
-                        axis=1) / np.sum(estimator_weights)
-        return scores.ravel()
+        # normalize the weights rather than the combined scores, so that the
+        # estimator axis is contracted with a single matrix-vector product
+        estimator_weights = estimator_weights.ravel().astype(scores.dtype,
+                                                             copy=False)
+        if not _pre_normalized:
+            weight_sum = np.sum(estimator_weights)
+            if abs(weight_sum - 1) > 1e-12:
+                estimator_weights = estimator_weights / weight_sum
+
+        scores = np.dot(scores, estimator_weights)
+        return scores
 
     else:
-        return np.mean(scores, axis=1).ravel()
+        return np.mean(scores, axis=1)
 
 
 def maximization(scores):
@@ -265,8 +473,13 @@ def maximization(scores):
 
     """
 
-    scores = check_array(scores)
-    return np.max(scores, axis=1).ravel()
+    scores = check_array(scores, dtype=[np.float64, np.float32])
+    if _row_max is not None:
+        combined_scores = np.empty(scores.shape[0], dtype=scores.dtype)
+        _row_max(scores, combined_scores)
+        return combined_scores
+
+    return np.max(scores, axis=1)
 
 
 def median(scores):
@@ -285,8 +498,17 @@ def median(scores):
 
     """
 
-    scores = check_array(scores)
-    return np.median(scores, axis=1).ravel()
+    scores = check_array(scores, dtype=[np.float64, np.float32])
+
+    # select the middle element(s) of each row instead of sorting it
+    n_estimators = scores.shape[1]
+    k = n_estimators // 2
+    if n_estimators % 2 == 1:
+        # copy the middle column out of the partitioned temporary
+        return np.ascontiguousarray(np.partition(scores, k, axis=1)[:, k])
+
+    scores = np.partition(scores, [k - 1, k], axis=1)
+    return 0.5 * (scores[:, k - 1] + scores[:, k])
 
 
 def majority_vote(scores, n_classes=2, weights=None):
@@ -311,14 +533,16 @@ def majority_vote(scores, n_classes=2, weights=None):
 
     """
 
-    scores = check_array(scores)
+    # votes are discrete so integer labels are kept as they are
+    scores = check_array(scores,
+                         dtype=[np.int64, np.int32, np.float64, np.float32])
 
     # assert only discrete scores are combined with majority vote
     check_classification_targets(scores)
 
     n_samples, n_estimators = scores.shape[0], scores.shape[1]
 
-    vote_results = np.zeros([n_samples, ])
+    vote_results = np.empty([n_samples, ])
 
     if weights is not None:
         assert_equal(scores.shape[1], weights.shape[1])
@@ -327,7 +551,48 @@ def majority_vote(scores, n_classes=2, weights=None):
     else:
         weights = np.ones([1, n_estimators])
 
-    for i in range(n_samples):
-        vote_results[i] = weighted_mode(scores[i, :], weights)[0][0]
-
-    return vote_results.ravel()
+    # fast path: tally the weighted votes of all samples at once when the
+    # labels can be used directly as column indices of the tally matrix.
+    # The tally is only worth it while it is no wider than the votes
+    # themselves, wider label spaces use the sorting path below.
+    if n_classes <= n_estimators and scores.min() >= 0 \
+            and scores.max() < n_classes:
+        scores_int = scores.astype(np.intp, copy=False)
+        if _weighted_mode_rows is not None:
+            _weighted_mode_rows(scores_int,
+                                weights.ravel().astype(float, copy=False),
+                                n_classes, vote_results)
+            return vote_results
+
+        tally = np.zeros([n_samples, n_classes])
+        np.add.at(tally, (np.arange(n_samples)[:, np.newaxis], scores_int),
+                  np.broadcast_to(weights.ravel(), scores.shape))
+        # argmax picks the smallest label on ties, same as weighted_mode,
+        # which also falls back to 0 if no label has a positive weight
+        vote_results[:] = tally.argmax(axis=1)
+        vote_results[tally.max(axis=1) <= 0] = 0
+        return vote_results
+
+    # otherwise sort the labels of every row once and sum up the weights of
+    # each run of equal labels
+    order = np.argsort(scores, axis=1, kind='mergesort')
+    row_ind = np.arange(n_samples)[:, np.newaxis]
+    sorted_scores = scores[row_ind, order]
+    sorted_weights = weights.ravel()[order]
+
+    run_starts = np.ones([n_samples, n_estimators], dtype=bool)
+    run_starts[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    run_starts = np.flatnonzero(run_starts)
+
+    run_labels = sorted_scores.ravel()[run_starts]
+    run_weights = np.add.reduceat(sorted_weights.ravel(), run_starts)
+    run_rows = run_starts // n_estimators
+
+    # order the runs by row, then by weight descending and label ascending,
+    # so the first run of each row holds the voted label
+    run_order = np.lexsort((run_labels, -run_weights, run_rows))
+    first_runs = run_order[np.r_[True, np.diff(run_rows[run_order]) != 0]]
+    vote_results[:] = np.where(run_weights[first_runs] > 0,
+                               run_labels[first_runs], 0)
+
+    return vote_results
@@ -4,6 +4,7 @@ import os
 import sys
 
 import unittest
+from unittest.mock import patch
 # noinspection PyProtectedMember
 from numpy.testing import assert_allclose
 from numpy.testing import assert_array_equal
@@ -11,18 +12,24 @@ from numpy.testing import assert_equal
 from numpy.testing import assert_raises
 
 import numpy as np
+from sklearn.utils import check_random_state
 from sklearn.utils import shuffle
+from sklearn.utils.random import sample_without_replacement
 
 # temporary solution for relative imports in case combo is not installed
 # if combo is installed, no need to use the following line
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from combo.models import score_comb
 from combo.models.score_comb import aom
 from combo.models.score_comb import moa
 from combo.models.score_comb import average
 from combo.models.score_comb import maximization
 from combo.models.score_comb import median
 from combo.models.score_comb import majority_vote
+from combo.models.score_comb import _make_buckets
+from combo.models.score_comb import _make_buckets_cached
+from combo.models.score_comb import _normalize_weights
 
 
 class TestAOM(unittest.TestCase):
@@ -56,6 +63,10 @@ class TestAOM(unittest.TestCase):
                     random_state=42)
         assert_equal(score.shape, (4,))
 
+        # every bucket draws its own estimators
+        bucket_ind, _ = _make_buckets(6, 3, 'static', True, 42)
+        assert_equal(len(set(map(tuple, bucket_ind))) > 1, True)
+
     def test_aom_static_n_buckets(self):
         with assert_raises(ValueError):
             aom(self.scores, 5, method='static', bootstrap_estimators=False,
@@ -71,6 +82,43 @@ class TestAOM(unittest.TestCase):
 
         # TODO: add more complicated testcases
 
+    def test_aom_dynamic_buckets(self):
+        scores = np.random.RandomState(0).rand(10, 20)
+        score = aom(scores, 4, method='dynamic', random_state=42)
+
+        # each bucket draws its own size and estimators from one generator
+        random_state = check_random_state(42)
+        bucket_sizes = random_state.randint(2, 10, size=4)
+        manual_scores = np.zeros([10, 4])
+        for i, bucket_size in enumerate(bucket_sizes):
+            ind = sample_without_replacement(20, bucket_size,
+                                             random_state=random_state)
+            manual_scores[:, i] = np.max(scores[:, ind], axis=1)
+
+        assert_allclose(score, np.mean(manual_scores, axis=1))
+
+    def test_aom_float32(self):
+        scores = self.scores.astype(np.float32)
+        for method in ['static', 'dynamic']:
+            score = aom(scores, 3, method=method, random_state=42)
+            assert_equal(score.dtype, np.float32)
+            assert_allclose(score, aom(self.scores, 3, method=method,
+                                       random_state=42), rtol=1e-6)
+
+    def test_aom_seeded_repeat_calls(self):
+        # bucket plans of integer seeds are served from the cache
+        for method in ['static', 'dynamic']:
+            aom(self.scores, 3, method=method, random_state=42)
+            hits = _make_buckets_cached.cache_info().hits
+            aom(self.scores, 3, method=method, random_state=42)
+            assert_equal(_make_buckets_cached.cache_info().hits, hits + 1)
+
+            # cached plans are shared and must not be editable
+            bucket_ind, bucket_sizes = _make_buckets_cached(
+                6, 3, method, False, 42)
+            assert_equal(bucket_ind.flags.writeable, False)
+            assert_equal(bucket_sizes.flags.writeable, False)
+
     def tearDown(self):
         pass
 
@@ -136,6 +184,12 @@ class TestStatic(unittest.TestCase):
         score = average(self.scores, self.weights)
         assert_allclose(score, np.array([1.75, 3.75, 5.75]))
 
+    def test_weighted_average_pre_normalized(self):
+        weights = _normalize_weights(self.weights)
+        assert_allclose(np.sum(weights), 1)
+        score = average(self.scores, weights, _pre_normalized=True)
+        assert_allclose(score, np.array([1.75, 3.75, 5.75]))
+
     def test_maximization(self):
         score = maximization(self.scores)
         assert_allclose(score, np.array([2, 4, 6]))
@@ -144,6 +198,19 @@ class TestStatic(unittest.TestCase):
         score = median(np.array([[0, 1, 2], [2, 3, 4], [5, 6, 7]]))
         assert_allclose(score, np.array([1, 3, 6]))
 
+        score = median(np.array([[3, 0, 1, 2], [2, 5, 4, 3], [5, 8, 6, 7]]))
+        assert_allclose(score, np.array([1.5, 3.5, 6.5]))
+
+    def test_float32(self):
+        scores = self.scores.astype(np.float32)
+        for combiner in [average, maximization, median]:
+            assert_equal(combiner(scores).dtype, np.float32)
+            assert_allclose(combiner(scores), combiner(self.scores))
+
+        score = average(scores, self.weights)
+        assert_equal(score.dtype, np.float32)
+        assert_allclose(score, np.array([1.75, 3.75, 5.75]))
+
 
 class TestMajorityVote(unittest.TestCase):
     def setUp(self):
@@ -158,6 +225,101 @@ class TestMajorityVote(unittest.TestCase):
         score = majority_vote(self.scores, n_classes=3, weights=self.weights)
         assert_allclose(score, np.array([1, 1, 2, 1]))
 
+    def test_majority_vote_continuous_float32(self):
+        # continuous scores must be rejected instead of truncated
+        scores = np.array([[0.5, 1.5, 1.2], [0.2, 0.7, 1.9]],
+                          dtype=np.float32)
+        with assert_raises(ValueError):
+            majority_vote(scores, n_classes=2)
+
+    def test_majority_vote_large_n_classes(self):
+        # a wide label space must not allocate a tally per class
+        score = majority_vote(self.scores, n_classes=10 ** 9)
+        assert_allclose(score, np.array([1, 0, 2, 1]))
+
+        score = majority_vote(self.scores, n_classes=10 ** 9,
+                              weights=self.weights)
+        assert_allclose(score, np.array([1, 1, 2, 1]))
+
+    def test_majority_vote_kernel_skipped_for_large_n_classes(self):
+        # the kernel scans a tally of n_classes per row, so it must not run
+        # for label spaces wider than the votes
+        def kernel(*args):
+            raise AssertionError('kernel called for a wide label space')
+
+        with patch.object(score_comb, '_weighted_mode_rows', kernel):
+            score = majority_vote(self.scores, n_classes=10 ** 6)
+        assert_allclose(score, np.array([1, 0, 2, 1]))
+
+    def test_majority_vote_non_positive_weights(self):
+        # as in weighted_mode, a vote without a positive total weight is 0,
+        # whichever code path n_classes selects
+        scores = np.array([[1, 1, 2], [0, 2, 2]])
+        weights = np.array([[0., 0., 0.]])
+        for n_classes in [2, 3]:
+            assert_allclose(majority_vote(scores, n_classes, weights),
+                            np.array([0, 0]))
+
+        weights = np.array([[-1., 2., -1.]])
+        for n_classes in [2, 3]:
+            assert_allclose(majority_vote(scores, n_classes, weights),
+                            np.array([1, 2]))
+
+        # an absent class with zero weight does not beat a negative label
+        weights = np.array([[-1., -1., -1.]])
+        with patch.object(score_comb, '_weighted_mode_rows', None):
+            for n_classes in [2, 3]:
+                assert_allclose(majority_vote(scores, n_classes, weights),
+                                np.array([0, 0]))
+
+    def test_majority_vote_out_of_range_labels(self):
+        # labels beyond n_classes should still be voted correctly
+        score = majority_vote(self.scores + 2, n_classes=2)
+        assert_allclose(score, np.array([3, 2, 4, 3]))
+
+        score = majority_vote(self.scores - 1, n_classes=3,
+                              weights=self.weights)
+        assert_allclose(score, np.array([0, 0, 1, 0]))
+
+
+class TestNumpyFallback(unittest.TestCase):
+    """The NumPy code paths taken when numba is unavailable should agree with
+    the numba kernels up to rounding.
+    """
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.scores = random_state.rand(50, 12)
+        self.votes = random_state.randint(0, 4, size=(50, 7))
+        self.weights = random_state.rand(1, 7)
+
+    def _combine(self):
+        results = []
+        for combiner in [aom, moa]:
+            for bootstrap_estimators in [False, True]:
+                results.append(combiner(
+                    self.scores, 3, method='static',
+                    bootstrap_estimators=bootstrap_estimators,
+                    random_state=42))
+        results.append(maximization(self.scores))
+        results.append(majority_vote(self.votes, n_classes=4))
+        results.append(majority_vote(self.votes, n_classes=4,
+                                     weights=self.weights))
+        return results
+
+    def test_fallback_matches_kernels(self):
+        kernel_results = self._combine()
+
+        with patch.object(score_comb, '_aom_kernel', None), \
+                patch.object(score_comb, '_moa_kernel', None), \
+                patch.object(score_comb, '_row_max', None), \
+                patch.object(score_comb, '_weighted_mode_rows', None):
+            fallback_results = self._combine()
+
+        for kernel_result, fallback_result in zip(kernel_results,
+                                                  fallback_results):
+            assert_allclose(fallback_result, kernel_result)
+
 
 if __name__ == '__main__':
     unittest.main()